@@ -0,0 +1,163 @@
+"""
+Document Store Module
+Persists document metadata and processing results in SQLite so they survive
+restarts and are shared between uvicorn workers
+"""
+
+import orjson
+import time
+import logging
+from typing import List, Dict, Optional
+import aiosqlite
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class DocumentStore:
+    """SQLite-backed store for document metadata and cached OCR results"""
+
+    def __init__(self, db_path: str = "./documents.db"):
+        """
+        Initialize document store
+
+        Args:
+            db_path: Path to the SQLite database file
+        """
+        self.db_path = db_path
+        self.db = None
+
+    async def connect(self):
+        """Open the database, enable WAL mode and create the schema"""
+        self.db = await aiosqlite.connect(self.db_path)
+        self.db.row_factory = aiosqlite.Row
+
+        # WAL lets readers in other workers proceed while one worker writes
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.execute("PRAGMA synchronous=NORMAL")
+        await self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT PRIMARY KEY,
+                filename TEXT,
+                total_pages INT,
+                total_chunks INT,
+                status TEXT,
+                ocr_json BLOB,
+                rag_json BLOB,
+                created_at REAL
+            )
+            """
+        )
+        await self.db.commit()
+        logger.info(f"Document store opened at {self.db_path}")
+
+    async def close(self):
+        """Close the database connection"""
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    @staticmethod
+    def _to_document(row: aiosqlite.Row) -> Dict:
+        """Convert a row to the document metadata dict returned by the API"""
+        return {
+            'document_id': row['id'],
+            'filename': row['filename'],
+            'total_pages': row['total_pages'],
+            'total_chunks': row['total_chunks'],
+            'status': row['status']
+        }
+
+    async def save(self, document: Dict, ocr_result: Dict, rag_summary: Dict):
+        """
+        Insert or replace a processed document
+
+        Args:
+            document: Document metadata (document_id, filename, totals, status)
+            ocr_result: OCR processing result
+            rag_summary: Summary returned by RAGPipeline.add_document
+        """
+        await self.db.execute(
+            """
+            INSERT OR REPLACE INTO documents
+                (id, filename, total_pages, total_chunks, status, ocr_json, rag_json, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                document['document_id'],
+                document['filename'],
+                document['total_pages'],
+                document['total_chunks'],
+                document['status'],
+                orjson.dumps(ocr_result),
+                orjson.dumps(rag_summary),
+                time.time()
+            )
+        )
+        await self.db.commit()
+
+    async def get(self, document_id: str) -> Optional[Dict]:
+        """
+        Get a document's metadata
+
+        Args:
+            document_id: Document identifier
+
+        Returns:
+            Document metadata or None if not found
+        """
+        async with self.db.execute(
+            "SELECT id, filename, total_pages, total_chunks, status FROM documents WHERE id = ?",
+            (document_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return self._to_document(row) if row else None
+
+    async def exists(self, document_id: str) -> bool:
+        """Check whether a document has been processed"""
+        async with self.db.execute(
+            "SELECT 1 FROM documents WHERE id = ?",
+            (document_id,)
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def get_results(self, document_id: str) -> Optional[Dict]:
+        """
+        Get a document's stored OCR result and RAG summary
+
+        Args:
+            document_id: Document identifier
+
+        Returns:
+            Dict with 'ocr_result' and 'rag_summary', or None if not found
+        """
+        async with self.db.execute(
+            "SELECT ocr_json, rag_json FROM documents WHERE id = ?",
+            (document_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        return {
+            'ocr_result': orjson.loads(row['ocr_json']),
+            'rag_summary': orjson.loads(row['rag_json'])
+        }
+
+    async def list(self) -> List[Dict]:
+        """
+        List all documents
+
+        Returns:
+            List of document metadata, oldest first
+        """
+        async with self.db.execute(
+            "SELECT id, filename, total_pages, total_chunks, status FROM documents ORDER BY created_at"
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return [self._to_document(row) for row in rows]
+
+    async def delete(self, document_id: str):
+        """Delete a document"""
+        await self.db.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+        await self.db.commit()
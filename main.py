@@ -3,19 +3,25 @@ FastAPI Backend for PDF OCR and Chat Processing
 """
 
 import os
+import asyncio
 import tempfile
 import logging
 import hashlib
+import xxhash
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import List, Optional
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 from ocr_pipeline import OCRPipeline
 from rag_pipeline import RAGPipeline, LLMHandler
+from document_store import DocumentStore
 
 # Load environment variables from .env file
 load_dotenv()
@@ -34,7 +40,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="ChatPDF Service",
     description="Backend API for PDF text extraction, table/form detection, and intelligent Q&A",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -46,13 +53,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
 # Initialize pipelines (lazy loading)
 ocr_pipeline = None
 rag_pipeline = None
 llm_handler = None
 
-# Store document metadata
-documents_db = {}  # In-memory storage (use database in production)
+# Store document metadata and processed results (SQLite, shared by workers);
+# identical re-uploads (same content hash) are served from here without OCR
+document_store = DocumentStore(db_path=os.getenv("DOCUMENTS_DB_PATH", "./documents.db"))
+
+# Retrieved chunks per (document_id, question hash), so repeated questions
+# skip the query embedding and the vector search
+query_cache = TTLCache(maxsize=1024, ttl=3600)
 
 
 # Pydantic models for request/response
@@ -105,9 +118,90 @@ def get_llm_handler() -> LLMHandler:
     return llm_handler
 
 
-def generate_document_id(filename: str, content: bytes) -> str:
+@app.on_event("startup")
+async def start_processing_executor():
+    """Create the executor that runs blocking OCR/embedding work off the event loop"""
+    # Threads are enough here: page-level OCR already runs in the OCR
+    # pipeline's process pool, so these threads mostly wait on it
+    app.state.processing_executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("MAX_CONCURRENT_JOBS", "4")),
+        thread_name_prefix="processing"
+    )
+
+
+@app.on_event("startup")
+async def open_document_store():
+    """Open the document store"""
+    await document_store.connect()
+
+
+@app.on_event("startup")
+async def warmup_pipelines():
+    """Load all pipelines and models at startup instead of on the first request"""
+    logger.info("Warming up pipelines...")
+    ocr_pipe = await run_blocking(get_ocr_pipeline)
+    await run_blocking(ocr_pipe.warmup)
+    await run_blocking(get_rag_pipeline)
+    await run_blocking(get_llm_handler)
+    logger.info("Pipelines warmed up")
+
+
+@app.on_event("shutdown")
+async def stop_processing_executor():
+    """Shut down the processing executor and the OCR worker pool"""
+    app.state.processing_executor.shutdown(wait=False)
+    if ocr_pipeline is not None:
+        ocr_pipeline.close()
+    await document_store.close()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking pipeline call in the processing executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        app.state.processing_executor,
+        partial(func, *args, **kwargs)
+    )
+
+
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+
+async def save_upload_to_temp(file: UploadFile) -> tuple[str, str, int]:
+    """
+    Stream an upload to a temporary file, hashing it on the way
+    
+    Args:
+        file: Uploaded PDF file
+    
+    Returns:
+        Tuple of (temp_file_path, content_hash, size_in_bytes)
+    """
+    # xxh3 is non-cryptographic, which is fine for IDs, and much faster than
+    # MD5/BLAKE2 on large uploads
+    hasher = xxhash.xxh3_64()
+    size = 0
+    
+    # Single pass over the bytes: hash each chunk and write it straight to
+    # the raw fd (mkstemp creates it 0o600), with no buffered file copy
+    fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb', buffering=0) as temp:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                view = memoryview(chunk)
+                while view:
+                    view = view[temp.write(view):]
+                size += len(chunk)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+    
+    return temp_path, hasher.hexdigest()[:8], size
+
+
+def generate_document_id(filename: str, content_hash: str) -> str:
     """Generate unique document ID from filename and content hash"""
-    content_hash = hashlib.md5(content).hexdigest()[:8]
     clean_filename = Path(filename).stem.replace(' ', '_')[:20]
     return f"{clean_filename}_{content_hash}"
 
@@ -152,16 +246,25 @@ async def upload_and_process_pdf(file: UploadFile = File(...)):
     
     temp_file = None
     try:
-        # Read file content
-        content = await file.read()
+        # Save uploaded file to temporary location
+        temp_file, content_hash, _ = await save_upload_to_temp(file)
         
         # Generate document ID
-        document_id = generate_document_id(file.filename, content)
+        document_id = generate_document_id(file.filename, content_hash)
         
-        # Save uploaded file to temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp:
-            temp.write(content)
-            temp_file = temp.name
+        # Return stored results for documents that were already processed
+        cached = await document_store.get_results(document_id)
+        if cached:
+            logger.info(f"Returning cached results for {document_id}")
+            return ORJSONResponse(content={
+                'document_id': document_id,
+                'filename': file.filename,
+                'status': 'success',
+                'ocr_result': cached['ocr_result'],
+                'rag_summary': cached['rag_summary'],
+                'cached': True,
+                'message': 'Document already processed. You can now ask questions!'
+            })
         
         logger.info(f"Processing file: {file.filename} as document_id: {document_id}")
         
@@ -171,28 +274,32 @@ async def upload_and_process_pdf(file: UploadFile = File(...)):
         
         # Step 1: Process PDF with OCR
         logger.info(f"Running OCR on {file.filename}...")
-        ocr_result = ocr_pipe.process_pdf(temp_file)
+        ocr_result = await run_blocking(ocr_pipe.process_pdf, temp_file)
         
         # Step 2: Add to vector database
         logger.info(f"Adding document to vector database...")
-        rag_summary = rag_pipe.add_document(
+        rag_summary = await rag_pipe.add_document_async(
             document_id=document_id,
             ocr_result=ocr_result,
             metadata={'filename': file.filename}
         )
         
         # Store document metadata
-        documents_db[document_id] = {
-            'document_id': document_id,
-            'filename': file.filename,
-            'total_pages': len(ocr_result['pages']),
-            'total_chunks': rag_summary['total_chunks'],
-            'status': 'ready'
-        }
+        await document_store.save(
+            {
+                'document_id': document_id,
+                'filename': file.filename,
+                'total_pages': len(ocr_result['pages']),
+                'total_chunks': rag_summary['total_chunks'],
+                'status': 'ready'
+            },
+            ocr_result,
+            rag_summary
+        )
         
         logger.info(f"Successfully processed {file.filename} -> {document_id}")
         
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             'document_id': document_id,
             'filename': file.filename,
             'status': 'success',
@@ -231,7 +338,7 @@ async def chat_with_document(chat_request: ChatRequest):
         question = chat_request.question
         
         # Check if document exists
-        if document_id not in documents_db:
+        if not await document_store.exists(document_id):
             raise HTTPException(
                 status_code=404,
                 detail=f"Document '{document_id}' not found. Please upload it first."
@@ -244,14 +351,21 @@ async def chat_with_document(chat_request: ChatRequest):
         llm = get_llm_handler()
         
         # Step 1: Retrieve relevant chunks
-        relevant_chunks = rag_pipe.retrieve_relevant_chunks(
-            document_id=document_id,
-            query=question,
-            top_k=5
-        )
+        cache_key = (document_id, hashlib.sha256(question.encode()).hexdigest())
+        relevant_chunks = query_cache.get(cache_key)
+        if relevant_chunks is None:
+            relevant_chunks = rag_pipe.retrieve_relevant_chunks(
+                document_id=document_id,
+                query=question,
+                top_k=5
+            )
+            if relevant_chunks.texts:
+                query_cache[cache_key] = relevant_chunks
+        else:
+            logger.info(f"Using cached chunks for question on {document_id}")
         
-        if not relevant_chunks:
-            return JSONResponse(content={
+        if not relevant_chunks.texts:
+            return ORJSONResponse(content={
                 'answer': 'I could not find relevant information in the document to answer your question.',
                 'sources': [],
                 'document_id': document_id
@@ -266,7 +380,7 @@ async def chat_with_document(chat_request: ChatRequest):
         
         result['document_id'] = document_id
         
-        return JSONResponse(content=result)
+        return ORJSONResponse(content=result)
         
     except HTTPException as he:
         raise he
@@ -283,9 +397,10 @@ async def list_documents():
     Returns:
         List of documents with metadata
     """
+    documents = await document_store.list()
     return {
-        'documents': list(documents_db.values()),
-        'total': len(documents_db)
+        'documents': documents,
+        'total': len(documents)
     }
 
 
@@ -300,10 +415,11 @@ async def get_document_info(document_id: str):
     Returns:
         Document metadata
     """
-    if document_id not in documents_db:
+    document = await document_store.get(document_id)
+    if document is None:
         raise HTTPException(status_code=404, detail=f"Document '{document_id}' not found")
     
-    return documents_db[document_id]
+    return document
 
 
 @app.delete("/documents/{document_id}")
@@ -317,7 +433,7 @@ async def delete_document(document_id: str):
     Returns:
         Deletion status
     """
-    if document_id not in documents_db:
+    if not await document_store.exists(document_id):
         raise HTTPException(status_code=404, detail=f"Document '{document_id}' not found")
     
     try:
@@ -326,7 +442,9 @@ async def delete_document(document_id: str):
         rag_pipe.delete_document(document_id)
         
         # Delete from metadata
-        del documents_db[document_id]
+        await document_store.delete(document_id)
+        for cache_key in [key for key in query_cache if key[0] == document_id]:
+            query_cache.pop(cache_key, None)
         
         logger.info(f"Deleted document: {document_id}")
         
@@ -357,22 +475,19 @@ async def process_pdf_ocr_only(file: UploadFile = File(...)):
     temp_file = None
     try:
         # Save uploaded file to temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp:
-            content = await file.read()
-            temp.write(content)
-            temp_file = temp.name
+        temp_file, _, size = await save_upload_to_temp(file)
         
-        logger.info(f"Processing file: {file.filename} ({len(content)} bytes)")
+        logger.info(f"Processing file: {file.filename} ({size} bytes)")
         
         # Get OCR pipeline
         pipeline = get_ocr_pipeline()
         
         # Process PDF
-        result = pipeline.process_pdf(temp_file)
+        result = await run_blocking(pipeline.process_pdf, temp_file)
         
         logger.info(f"Successfully processed {file.filename}")
         
-        return JSONResponse(content=result)
+        return ORJSONResponse(content=result)
         
     except Exception as e:
         logger.error(f"Error processing PDF: {str(e)}", exc_info=True)
@@ -5,58 +5,229 @@ table extraction with Camelot, and form field detection
 """
 
 import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 import cv2
 import numpy as np
 import fitz  # PyMuPDF
-from pdf2image import convert_from_path
 from paddleocr import PaddleOCR
 from PIL import Image
 import logging
+from typing import Optional
 import camelot
 import pandas as pd
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Per-process pipeline used by pool workers (PaddleOCR is not fork-safe,
+# so every worker builds its own instance in _init_worker)
+_worker_pipeline = None
+
+
+def _init_worker(ocr_backend: str):
+    """Pool initializer: build a single-process OCR pipeline for this worker"""
+    global _worker_pipeline
+    _worker_pipeline = OCRPipeline(num_workers=1, ocr_backend=ocr_backend)
+
+
+def _noop(_):
+    """Pool task that does nothing; warmup uses it to wait for worker initializers"""
+    return None
+
+
+def _process_pages(pdf_path: str, force_ocr: bool, page_run: tuple) -> list:
+    """Pool task: process a (start, stop) run of pages, opening the PDF once per task"""
+    with fitz.open(pdf_path) as doc:
+        return _worker_pipeline.process_pages(doc.pages(*page_run), pdf_path, force_ocr)
+
+
+class RapidOCREngine:
+    """
+    ONNX Runtime OCR engine with PaddleOCR's call and result format
+    
+    Wraps rapidocr-onnxruntime, which runs PaddleOCR's det/cls/rec models
+    converted to ONNX, so onnxruntime's MLAS kernels are used on CPU.
+    """
+    
+    def __init__(self):
+        """Load the ONNX detection, classification and recognition models"""
+        from rapidocr_onnxruntime import RapidOCR
+        self.engine = RapidOCR()
+    
+    def ocr(self, image: np.ndarray, cls: bool = True) -> list:
+        """
+        Run OCR on one image
+        
+        Args:
+            image: Image as numpy array
+            cls: Run the text-direction classifier
+        
+        Returns:
+            A one-element list holding the image's [box, (text, confidence)] lines
+        """
+        lines, _ = self.engine(image, use_cls=cls)
+        # RapidOCR may return numpy scalars, which orjson and Chroma reject
+        return [[[box, (str(text), float(score))] for box, text, score in lines or []]]
+
 
 class OCRPipeline:
     """OCR processing pipeline for PDF documents with table and form extraction"""
     
-    def __init__(self):
-        """Initialize PaddleOCR with English language support"""
-        self.ocr = PaddleOCR(
-            use_angle_cls=True,
-            lang='en'
-        )
+    def __init__(
+        self,
+        num_workers: int = None,
+        ocr_backend: Optional[str] = None
+    ):
+        """
+        Initialize PaddleOCR with English language support
+        
+        Args:
+            num_workers: Number of worker processes used to process pages
+                in parallel (defaults to the CPU count, 1 disables the pool)
+            ocr_backend: 'paddle' (default) or 'onnx' to run the PaddleOCR
+                models through ONNX Runtime; falls back to the OCR_BACKEND
+                environment variable
+        """
+        self.ocr_backend = (ocr_backend or os.getenv("OCR_BACKEND", "paddle")).lower()
+        if self.ocr_backend == "onnx":
+            logger.info("Using ONNX Runtime OCR backend")
+            self.ocr = RapidOCREngine()
+        else:
+            self.ocr = PaddleOCR(
+                use_angle_cls=True,
+                lang='en'
+            )
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # PaddleOCR predictors are not thread-safe; serializes in-process OCR
+        self._ocr_lock = threading.Lock()
+        # Per-thread scratch buffers reused across pages by preprocess_image
+        self._preproc_buffers = threading.local()
+    
+    def _get_pool(self):
+        """Get or lazily start the worker pool (kept alive across documents)"""
+        with self._pool_lock:
+            if self._pool is None:
+                # Always spawn: by now this process has loaded PaddleOCR and
+                # its OpenMP/MKL thread pools, which do not survive a fork
+                ctx = multiprocessing.get_context("spawn")
+                logger.info(f"Starting OCR worker pool with {self.num_workers} processes")
+                # Unlike multiprocessing.Pool, the executor fails pending tasks
+                # with BrokenProcessPool when a worker dies (OOM kill, segfault)
+                # instead of waiting on them forever
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.num_workers,
+                    mp_context=ctx,
+                    initializer=_init_worker,
+                    initargs=(self.ocr_backend,)
+                )
+            return self._pool
     
-    def extract_native_text(self, pdf_path: str, page_num: int) -> str:
+    def _discard_pool(self, pool: ProcessPoolExecutor):
+        """Drop a broken worker pool so the next document starts a fresh one"""
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    def warmup(self):
+        """Run a dummy OCR pass and start the worker pool so models are loaded before traffic"""
+        self.run_ocr(np.full((64, 256), 255, dtype=np.uint8))
+        if self.num_workers > 1:
+            # Starting the pool returns before _init_worker has loaded the
+            # models; one task per worker blocks until every worker is ready
+            list(self._get_pool().map(_noop, range(self.num_workers)))
+    
+    def close(self):
+        """Shut down the worker pool, if one was started"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+    
+    def extract_native_text(self, page: fitz.Page) -> str:
         """
         Extract native text from PDF page using PyMuPDF
         
         Args:
-            pdf_path: Path to PDF file
-            page_num: Page number (0-indexed)
+            page: PyMuPDF page
         
         Returns:
             Extracted text string
         """
         try:
-            doc = fitz.open(pdf_path)
-            page = doc[page_num]
-            text = page.get_text().strip()
-            doc.close()
-            return text
+            return page.get_text().strip()
         except Exception as e:
-            logger.error(f"Error extracting native text from page {page_num}: {e}")
+            logger.error(f"Error extracting native text from page {page.number}: {e}")
             return ""
     
-    def extract_tables(self, pdf_path: str, page_num: int) -> list:
+    def _table_to_dict(self, table_id: int, df: pd.DataFrame, accuracy: float) -> dict:
+        """Convert a table DataFrame (header in the first row) to the table dict schema"""
+        return {
+            'table_id': table_id,
+            'accuracy': round(accuracy, 2),
+            'rows': len(df),
+            'columns': len(df.columns),
+            'data': df.values.tolist(),
+            'headers': df.iloc[0].tolist() if len(df) > 0 else [],
+            'markdown': df.to_markdown(index=False)
+        }
+    
+    def extract_tables(self, page: fitz.Page, pdf_path: str, native_text: str = None) -> list:
+        """
+        Extract tables from PDF page
+        
+        Uses PyMuPDF's in-process table finder first. Camelot (which spawns
+        Ghostscript per call) is the rare fallback, for pages where that finds
+        nothing. It is skipped on scanned pages (Camelot reads the text layer)
+        and on text-native pages (over 50 characters of text) without images.
+        
+        Args:
+            page: PyMuPDF page
+            pdf_path: Path to PDF file (for Camelot)
+            native_text: Page text if already extracted
+        
+        Returns:
+            List of dictionaries containing table data
+        """
+        tables_data = []
+        page_num = page.number
+        
+        try:
+            for idx, tab in enumerate(page.find_tables().tables):
+                df = pd.DataFrame(tab.extract()).fillna('')
+                if not df.empty:
+                    # Vector tables are read from the PDF structure, so there is
+                    # no parsing accuracy to report
+                    tables_data.append(self._table_to_dict(idx + 1, df, 100.0))
+                    logger.info(f"Extracted table {idx + 1} from page {page_num + 1} with PyMuPDF")
+        except Exception as e:
+            logger.warning(f"Error finding tables on page {page_num + 1} with PyMuPDF: {e}")
+        
+        if tables_data:
+            return tables_data
+        
+        if native_text is None:
+            native_text = self.extract_native_text(page)
+        text = native_text.strip()
+        has_native_text = len(text) > 50
+        if not text or (has_native_text and not page.get_images(full=False)):
+            logger.info(f"Page {page_num + 1}: No table candidates, skipping Camelot")
+            return tables_data
+        
+        return self.extract_tables_camelot(pdf_path, page_num)
+    
+    def extract_tables_camelot(self, pdf_path: str, page_num: int) -> list:
         """
         Extract tables from PDF page using Camelot
         
         Args:
             pdf_path: Path to PDF file
-            page_num: Page number (1-indexed for Camelot)
+            page_num: Page number (0-indexed)
         
         Returns:
             List of dictionaries containing table data
@@ -84,39 +255,27 @@ class OCRPipeline:
                 
                 # Clean up the dataframe
                 if not df.empty:
-                    table_dict = {
-                        'table_id': idx + 1,
-                        'accuracy': round(table.parsing_report['accuracy'], 2),
-                        'rows': len(df),
-                        'columns': len(df.columns),
-                        'data': df.values.tolist(),
-                        'headers': df.iloc[0].tolist() if len(df) > 0 else [],
-                        'markdown': df.to_markdown(index=False)
-                    }
-                    tables_data.append(table_dict)
-                    logger.info(f"Extracted table {idx + 1} from page {page_num + 1} with accuracy {table.parsing_report['accuracy']:.2f}")
+                    accuracy = table.parsing_report['accuracy']
+                    tables_data.append(self._table_to_dict(idx + 1, df, accuracy))
+                    logger.info(f"Extracted table {idx + 1} from page {page_num + 1} with accuracy {accuracy:.2f}")
             
         except Exception as e:
             logger.warning(f"Error extracting tables from page {page_num + 1}: {e}")
         
         return tables_data
     
-    def extract_form_fields(self, pdf_path: str, page_num: int) -> list:
+    def extract_form_fields(self, page: fitz.Page) -> list:
         """
         Extract form fields from PDF page using PyMuPDF
         
         Args:
-            pdf_path: Path to PDF file
-            page_num: Page number (0-indexed)
+            page: PyMuPDF page
         
         Returns:
             List of dictionaries containing form field data
         """
         form_fields = []
         try:
-            doc = fitz.open(pdf_path)
-            page = doc[page_num]
-            
             # Get widgets (form fields) on the page
             widgets = page.widgets()
             
@@ -139,34 +298,65 @@ class OCRPipeline:
                     form_fields.append(field_info)
                     logger.info(f"Found form field: {field_info['field_name']} ({field_info['field_type']})")
             
-            doc.close()
-            
         except Exception as e:
-            logger.warning(f"Error extracting form fields from page {page_num + 1}: {e}")
+            logger.warning(f"Error extracting form fields from page {page.number + 1}: {e}")
         
         return form_fields
     
+    def _get_preproc_buffers(self, shape: tuple) -> tuple:
+        """
+        Get this thread's scratch buffers for preprocess_image
+        
+        Buffers are allocated on first use and reallocated only when the
+        page size changes, so consecutive pages reuse the same memory.
+        
+        Returns:
+            Tuple of (gray_buffer, work_buffer, laplacian_buffer)
+        """
+        buffers = getattr(self._preproc_buffers, 'buffers', None)
+        if buffers is None or buffers[0].shape != shape:
+            buffers = (
+                np.empty(shape, dtype=np.uint8),
+                np.empty(shape, dtype=np.uint8),
+                np.empty(shape, dtype=np.int16)
+            )
+            self._preproc_buffers.buffers = buffers
+        return buffers
+    
     def preprocess_image(self, image: np.ndarray) -> np.ndarray:
         """
         Preprocess image for better OCR results
         
+        Intermediate steps write into reused per-thread buffers; only the
+        thresholded result is newly allocated, since callers keep it around
+        for batched OCR.
+        
         Args:
             image: Input image as numpy array
         
         Returns:
             Preprocessed image
         """
+        gray_buf, work_buf, lap_buf = self._get_preproc_buffers(image.shape[:2])
+        
         # Convert to grayscale
         if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=gray_buf)
         else:
             gray = image
         
-        # Denoise
-        denoised = cv2.fastNlMeansDenoising(gray, None, 10, 7, 21)
+        # Denoise (a 3x3 median is enough for OCR; already-sharp scans skip it)
+        cv2.Laplacian(gray, cv2.CV_16S, dst=lap_buf)
+        _, stddev = cv2.meanStdDev(lap_buf)
+        if stddev[0][0] ** 2 > 500:
+            denoised = gray
+        else:
+            denoised = cv2.medianBlur(gray, 3, dst=work_buf)
         
-        # Deskew
-        coords = np.column_stack(np.where(denoised > 0))
+        # Deskew (estimate the angle on a quarter-scale copy; the angle is
+        # scale-invariant and this avoids a point cloud of every pixel)
+        small = cv2.resize(denoised, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+        coords = np.column_stack(np.where(small > 0)).astype(np.int32)
         if len(coords) > 0:
             angle = cv2.minAreaRect(coords)[-1]
             if angle < -45:
@@ -179,8 +369,12 @@ class OCRPipeline:
                 (h, w) = denoised.shape[:2]
                 center = (w // 2, h // 2)
                 M = cv2.getRotationMatrix2D(center, angle, 1.0)
+                # warpAffine cannot run in place; write into whichever buffer
+                # does not hold the source
+                target = gray_buf if denoised is work_buf else work_buf
                 denoised = cv2.warpAffine(
                     denoised, M, (w, h),
+                    dst=target,
                     flags=cv2.INTER_CUBIC,
                     borderMode=cv2.BORDER_REPLICATE
                 )
@@ -197,31 +391,26 @@ class OCRPipeline:
         
         return thresh
     
-    def pdf_page_to_image(self, pdf_path: str, page_num: int) -> np.ndarray:
+    def pdf_page_to_image(self, page: fitz.Page, dpi: int = 300) -> np.ndarray:
         """
         Convert PDF page to image
         
+        Renders in-process with PyMuPDF and wraps the pixmap samples in a
+        NumPy array without an intermediate PIL image.
+        
         Args:
-            pdf_path: Path to PDF file
-            page_num: Page number (1-indexed for pdf2image)
+            page: PyMuPDF page
+            dpi: Render resolution
         
         Returns:
-            Image as numpy array
+            RGB image as numpy array
         """
         try:
-            images = convert_from_path(
-                pdf_path,
-                first_page=page_num + 1,
-                last_page=page_num + 1,
-                dpi=300
-            )
-            if images:
-                # Convert PIL Image to numpy array
-                img_array = np.array(images[0])
-                return img_array
-            return None
+            zoom = dpi / 72
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
         except Exception as e:
-            logger.error(f"Error converting page {page_num} to image: {e}")
+            logger.error(f"Error converting page {page.number} to image: {e}")
             return None
     
     def run_ocr(self, image: np.ndarray) -> tuple[str, float]:
@@ -235,106 +424,163 @@ class OCRPipeline:
             Tuple of (extracted_text, average_confidence)
         """
         try:
-            result = self.ocr.ocr(image, cls=True)
+            with self._ocr_lock:
+                result = self.ocr.ocr(image, cls=True)
             
-            if not result or not result[0]:
+            if not result:
                 return "", 0.0
             
-            texts = []
-            confidences = []
-            
-            for line in result[0]:
-                if line:
-                    text = line[1][0]
-                    confidence = line[1][1]
-                    texts.append(text)
-                    confidences.append(confidence)
-            
-            extracted_text = "\n".join(texts)
-            avg_confidence = sum(confidences) / len(confidences) if confidences else 0.0
-            
-            return extracted_text, avg_confidence
+            return self._parse_ocr_lines(result[0])
             
         except Exception as e:
             logger.error(f"Error running OCR: {e}")
             return "", 0.0
     
-    def process_pdf(self, pdf_path: str) -> dict:
+    def _parse_ocr_lines(self, lines: list) -> tuple[str, float]:
+        """Join the text lines PaddleOCR found in one image and average their confidence"""
+        pairs = [(line[1][0], line[1][1]) for line in lines or [] if line]
+        if not pairs:
+            return "", 0.0
+        
+        texts, confidences = zip(*pairs)
+        return "\n".join(texts), sum(confidences) / len(confidences)
+    
+    def process_page(
+        self,
+        page: fitz.Page,
+        pdf_path: str,
+        force_ocr: bool = False
+    ) -> dict:
+        """
+        Extract text (native or OCR), tables, and forms from a single PDF page
+        
+        PaddleOCR's ocr() takes one image per call, so each page is OCR'd as
+        soon as it is rendered and only one 300 DPI image is alive at a time.
+        
+        Args:
+            page: PyMuPDF page
+            pdf_path: Path to PDF file (Camelot needs the path)
+            force_ocr: Run OCR even when the page has native text
+        
+        Returns:
+            Dictionary containing page results
+        """
+        page_num = page.number
+        logger.info(f"Processing page {page_num + 1}")
+        
+        page_result = {
+            "page_num": page_num + 1,
+            "text": "",
+            "source": "",
+            "confidence": 0.0,
+            "tables": [],
+            "forms": []
+        }
+        
+        # Try native text extraction
+        native_text = self.extract_native_text(page)
+        has_native_text = bool(native_text) and len(native_text.strip()) > 50
+        
+        # Extract tables
+        logger.info(f"Page {page_num + 1}: Extracting tables...")
+        page_result["tables"] = self.extract_tables(page, pdf_path, native_text)
+        
+        # Extract form fields
+        logger.info(f"Page {page_num + 1}: Extracting form fields...")
+        forms = self.extract_form_fields(page)
+        page_result["forms"] = forms
+        
+        if has_native_text and not force_ocr:
+            # Native text is substantial
+            page_result["text"] = native_text
+            page_result["source"] = "native"
+            page_result["confidence"] = 1.0
+            logger.info(f"Page {page_num + 1}: Using native text")
+        else:
+            # Need OCR
+            logger.info(f"Page {page_num + 1}: Running OCR")
+            
+            # Convert page to image
+            image = self.pdf_page_to_image(page)
+            
+            if image is not None:
+                ocr_text, confidence = self.run_ocr(self.preprocess_image(image))
+                page_result["text"] = ocr_text
+                page_result["source"] = "ocr"
+                page_result["confidence"] = round(confidence, 4)
+                logger.info(f"Page {page_num + 1}: OCR completed with confidence {confidence:.2f}")
+            else:
+                page_result["source"] = "error"
+                logger.error(f"Page {page_num + 1}: Failed to convert to image")
+        
+        return page_result
+    
+    def process_pages(self, pages, pdf_path: str, force_ocr: bool = False) -> list:
+        """
+        Process several pages in order
+        
+        Args:
+            pages: Iterable of PyMuPDF pages
+            pdf_path: Path to PDF file (Camelot needs the path)
+            force_ocr: Run OCR even when pages have native text
+        
+        Returns:
+            List of page results in page order
+        """
+        return [self.process_page(page, pdf_path, force_ocr) for page in pages]
+    
+    def process_pdf(self, pdf_path: str, force_ocr: bool = False) -> dict:
         """
         Process entire PDF and extract text, tables, and forms from all pages
         
+        Pages are independent, so they are fanned out to the worker pool;
+        with num_workers=1 they run in-process. process_pdf can be called
+        from several threads at once: each pool worker has its own PaddleOCR
+        instance, and in-process calls to the shared one are serialized by a
+        lock (native text, tables and forms still run concurrently).
+        
         Args:
             pdf_path: Path to PDF file
+            force_ocr: Run OCR on every page, even those with native text
         
         Returns:
             Dictionary containing processing results
         """
         try:
-            doc = fitz.open(pdf_path)
-            num_pages = len(doc)
-            doc.close()
-            
-            results = {
-                "file": os.path.basename(pdf_path),
-                "pages": []
-            }
-            
-            for page_num in range(num_pages):
-                logger.info(f"Processing page {page_num + 1}/{num_pages}")
+            with fitz.open(pdf_path) as doc:
+                num_pages = doc.page_count
                 
-                page_result = {
-                    "page_num": page_num + 1,
-                    "text": "",
-                    "source": "",
-                    "confidence": 0.0,
-                    "tables": [],
-                    "forms": []
-                }
-                
-                # Extract tables
-                logger.info(f"Page {page_num + 1}: Extracting tables...")
-                tables = self.extract_tables(pdf_path, page_num)
-                page_result["tables"] = tables
-                
-                # Extract form fields
-                logger.info(f"Page {page_num + 1}: Extracting form fields...")
-                forms = self.extract_form_fields(pdf_path, page_num)
-                page_result["forms"] = forms
-                
-                # Try native text extraction
-                native_text = self.extract_native_text(pdf_path, page_num)
-                
-                if native_text and len(native_text.strip()) > 50:
-                    # Native text is substantial
-                    page_result["text"] = native_text
-                    page_result["source"] = "native"
-                    page_result["confidence"] = 1.0
-                    logger.info(f"Page {page_num + 1}: Using native text")
+                if self.num_workers > 1:
+                    # Hand each worker a contiguous run of pages so it opens the
+                    # PDF once per run rather than once per page
+                    run_length = max(1, -(-num_pages // self.num_workers))
+                    page_runs = [
+                        (start, min(start + run_length, num_pages))
+                        for start in range(0, num_pages, run_length)
+                    ]
+                    logger.info(f"Processing {num_pages} pages in {len(page_runs)} runs")
+                    pool = self._get_pool()
+                    try:
+                        # map() yields runs in page order
+                        pages = [
+                            page
+                            for run in pool.map(
+                                partial(_process_pages, pdf_path, force_ocr),
+                                page_runs
+                            )
+                            for page in run
+                        ]
+                    except BrokenProcessPool:
+                        self._discard_pool(pool)
+                        raise
                 else:
-                    # Need OCR
-                    logger.info(f"Page {page_num + 1}: No native text, running OCR")
-                    
-                    # Convert page to image
-                    image = self.pdf_page_to_image(pdf_path, page_num)
-                    
-                    if image is not None:
-                        # Preprocess image
-                        preprocessed = self.preprocess_image(image)
-                        
-                        # Run OCR
-                        ocr_text, confidence = self.run_ocr(preprocessed)
-                        
-                        page_result["text"] = ocr_text
-                        page_result["source"] = "ocr"
-                        page_result["confidence"] = round(confidence, 4)
-                        logger.info(f"Page {page_num + 1}: OCR completed with confidence {confidence:.2f}")
-                    else:
-                        page_result["source"] = "error"
-                        logger.error(f"Page {page_num + 1}: Failed to convert to image")
-                
-                results["pages"].append(page_result)
+                    logger.info(f"Processing {num_pages} pages")
+                    pages = self.process_pages(doc, pdf_path, force_ocr)
             
-            return results
+            return {
+                "file": os.path.basename(pdf_path),
+                "pages": pages
+            }
             
         except Exception as e:
             logger.error(f"Error processing PDF: {e}")
@@ -4,12 +4,22 @@ Handles document chunking, embeddings, vector storage, and retrieval for ChatPDF
 """
 
 import os
+import sys
+import asyncio
 import logging
-from typing import List, Dict, Optional
+import pickle
+import hashlib
+import tempfile
+import sqlite3
+import threading
+from collections import namedtuple
+from itertools import islice
+from typing import List, Dict, Iterator, Optional, Tuple
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
-import tiktoken
+import numpy as np
+import diskcache
 from datetime import datetime
 import json
 from dotenv import load_dotenv
@@ -23,45 +33,439 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; MMR then runs as plain Python
+    prange = range
+    
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+# Retrieved chunks as parallel columns, best match first: texts and metadatas
+# are lists, page_nums (int32, -1 if unknown) and scores (float32) are arrays
+ChunkBatch = namedtuple('ChunkBatch', 'texts page_nums scores metadatas')
+
+
+def make_chunk_batch(texts: List[str], metadatas: List[Dict], scores) -> ChunkBatch:
+    """Build a ChunkBatch, pulling the page numbers out of the metadata"""
+    page_nums = np.fromiter(
+        (metadata.get('page_num', -1) for metadata in metadatas),
+        dtype=np.int32,
+        count=len(metadatas)
+    )
+    return ChunkBatch(texts, page_nums, np.asarray(scores, dtype=np.float32), metadatas)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _mmr_select(candidates: np.ndarray, relevance: np.ndarray, k: int, lambda_: float) -> np.ndarray:
+    """
+    Greedy maximal marginal relevance selection
+    
+    Args:
+        candidates: (n, dim) float32 embeddings of the candidate chunks
+        relevance: (n,) similarity of each candidate to the query
+        k: Number of candidates to select
+        lambda_: Trade-off between relevance (1.0) and diversity (0.0)
+    
+    Returns:
+        Row indices into candidates, in selection order
+    """
+    n, dim = candidates.shape
+    k = min(k, n)
+    selected = np.empty(k, dtype=np.int64)
+    chosen = np.zeros(n, dtype=np.bool_)
+    # Highest similarity of each candidate to anything selected so far
+    redundancy = np.full(n, -1.0, dtype=np.float32)
+    
+    for step in range(k):
+        best = -1
+        # Finite sentinel: fastmath assumes no infinities, so comparisons
+        # against -np.inf are undefined
+        best_score = -1e30
+        for i in range(n):
+            if chosen[i]:
+                continue
+            penalty = redundancy[i] if step > 0 else 0.0
+            score = lambda_ * relevance[i] - (1.0 - lambda_) * penalty
+            if score > best_score:
+                best_score = score
+                best = i
+        if best < 0:
+            # Only reachable with NaN scores; return what was selected
+            return selected[:step]
+        selected[step] = best
+        chosen[best] = True
+        
+        for i in prange(n):
+            similarity = 0.0
+            for j in range(dim):
+                similarity += candidates[i, j] * candidates[best, j]
+            if similarity > redundancy[i]:
+                redundancy[i] = similarity
+    
+    return selected
+
+
+class OnnxEmbeddingModel:
+    """
+    Sentence-transformers model exported to ONNX and int8-quantized
+    
+    Implements the subset of SentenceTransformer's interface used by
+    RAGPipeline (encode, get_sentence_embedding_dimension, tokenizer). The
+    export and dynamic quantization run once and are cached on disk.
+    """
+    
+    def __init__(self, model_name: str, cache_dir: str, max_seq_length: int = 256):
+        """
+        Load (exporting and quantizing first if needed) the ONNX model
+        
+        Args:
+            model_name: Hugging Face model id
+            cache_dir: Directory holding the exported model and tokenizer
+            max_seq_length: Maximum tokens per text, as in sentence-transformers
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        
+        model_path = os.path.join(cache_dir, "model_quantized.onnx")
+        if not os.path.exists(model_path):
+            self._export(model_name, cache_dir)
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(cache_dir)
+        self.max_seq_length = max_seq_length
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = os.cpu_count() or 1
+        available = ort.get_available_providers()
+        self.session = ort.InferenceSession(
+            model_path,
+            sess_options=options,
+            providers=[
+                provider
+                for provider in ['CUDAExecutionProvider', 'CPUExecutionProvider']
+                if provider in available
+            ]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.dim = self._embed_batch(["dimension probe"]).shape[1]
+        logger.info(f"Loaded ONNX embeddings model from {model_path}")
+    
+    @staticmethod
+    def _export(model_name: str, cache_dir: str):
+        """Export the model to ONNX and apply dynamic int8 quantization"""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+        
+        logger.info(f"Exporting {model_name} to ONNX (one-time)...")
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        model.save_pretrained(cache_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(cache_dir)
+        
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(
+            save_dir=cache_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        )
+    
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Run one batch through the model and mean-pool over real tokens"""
+        encoded = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors='np'
+        )
+        feeds = {
+            name: value.astype(np.int64)
+            for name, value in encoded.items()
+            if name in self.input_names
+        }
+        hidden = self.session.run(None, feeds)[0]
+        mask = encoded['attention_mask'][..., None].astype(np.float32)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        """Return the embedding dimension"""
+        return self.dim
+    
+    def encode(
+        self,
+        texts: List[str],
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False
+    ) -> np.ndarray:
+        """
+        Embed texts (same arguments as SentenceTransformer.encode)
+        
+        Texts are length-sorted before batching so padding stays small.
+        """
+        order = np.argsort([-len(text) for text in texts])
+        embeddings = np.empty((len(texts), self.dim), dtype=np.float32)
+        
+        for start in range(0, len(texts), batch_size):
+            batch_idx = order[start:start + batch_size]
+            embeddings[batch_idx] = self._embed_batch([texts[idx] for idx in batch_idx])
+        
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        
+        return embeddings
+
+
+class SemanticQueryCache:
+    """
+    LRU cache of retrieval results keyed by query embedding similarity
+    
+    A lookup is a single matrix-vector product against all cached query
+    embeddings; a cached result is reused when its query is within cosine
+    similarity `threshold` of the new one (same document and top_k).
+    """
+    
+    def __init__(self, dim: int, max_entries: int = 1024, threshold: float = 0.97):
+        """
+        Initialize an empty cache
+        
+        Args:
+            dim: Embedding dimension
+            max_entries: Maximum cached queries before LRU eviction
+            threshold: Minimum cosine similarity for a hit
+        """
+        self.threshold = threshold
+        self.embeddings = np.zeros((max_entries, dim), dtype=np.float32)
+        self.entries = [None] * max_entries  # (document_id, top_k, chunks)
+        self.last_used = np.zeros(max_entries, dtype=np.int64)  # 0 = free slot
+        self.clock = 0
+        self.lock = threading.Lock()
+    
+    def get(self, document_id: str, top_k: int, query_embedding: np.ndarray) -> Optional[ChunkBatch]:
+        """Return cached chunks for a near-identical query, or None"""
+        with self.lock:
+            scores = self.embeddings @ query_embedding
+            best_row, best_score = None, self.threshold
+            for row in np.flatnonzero(scores >= self.threshold):
+                entry = self.entries[row]
+                if entry[0] == document_id and entry[1] == top_k and scores[row] >= best_score:
+                    best_row, best_score = row, scores[row]
+            
+            if best_row is None:
+                return None
+            
+            self.clock += 1
+            self.last_used[best_row] = self.clock
+            return self.entries[best_row][2]
+    
+    def put(self, document_id: str, top_k: int, query_embedding: np.ndarray, chunks: ChunkBatch):
+        """Cache chunks for a query, evicting the least recently used entry if full"""
+        with self.lock:
+            row = int(np.argmin(self.last_used))
+            self.clock += 1
+            self.embeddings[row] = query_embedding
+            self.entries[row] = (document_id, top_k, chunks)
+            self.last_used[row] = self.clock
+    
+    def invalidate(self, document_id: str):
+        """Drop all cached queries for a document"""
+        with self.lock:
+            for row, entry in enumerate(self.entries):
+                if entry is not None and entry[0] == document_id:
+                    self.embeddings[row] = 0
+                    self.entries[row] = None
+                    self.last_used[row] = 0
+
 
 class RAGPipeline:
     """RAG pipeline for document processing and question answering"""
     
-    def __init__(self, persist_directory: str = "./chroma_db"):
+    def __init__(
+        self,
+        persist_directory: str = "./chroma_db",
+        vector_backend: Optional[str] = None,
+        vector_quantization: Optional[str] = None,
+        embedding_batch_size: int = 64,
+        embedding_backend: Optional[str] = None,
+        mmr_lambda: Optional[float] = None
+    ):
         """
         Initialize RAG pipeline with vector database and embeddings model
         
         Args:
-            persist_directory: Directory to persist ChromaDB data
+            persist_directory: Directory to persist vector database data
+            vector_backend: 'chroma' (default) or 'faiss'; falls back to the
+                VECTOR_BACKEND environment variable
+            vector_quantization: 'int8' (default) or 'none' for new FAISS
+                indexes; falls back to the VECTOR_QUANTIZATION environment variable
+            embedding_batch_size: Texts per forward pass of the embeddings model
+            embedding_backend: 'torch' (default) or 'onnx' for an int8-quantized
+                ONNX Runtime model; falls back to the EMBEDDING_BACKEND
+                environment variable
+            mmr_lambda: Enables MMR diversification of Chroma results
+                (1.0 = relevance only, 0.0 = diversity only); falls back to
+                the MMR_LAMBDA environment variable, unset disables it
         """
         self.persist_directory = persist_directory
+        self.vector_backend = (vector_backend or os.getenv("VECTOR_BACKEND", "chroma")).lower()
+        self.vector_quantization = (
+            vector_quantization or os.getenv("VECTOR_QUANTIZATION", "int8")
+        ).lower()
         
-        # Initialize ChromaDB
-        logger.info("Initializing ChromaDB...")
-        self.chroma_client = chromadb.PersistentClient(
-            path=persist_directory,
-            settings=Settings(anonymized_telemetry=False)
-        )
+        if self.vector_backend == "faiss":
+            # Exact inner-product search over normalized embeddings; one
+            # index + pickled chunk records per document
+            import faiss
+            self.faiss = faiss
+            self.faiss_directory = os.path.join(persist_directory, "faiss")
+            os.makedirs(self.faiss_directory, exist_ok=True)
+            self._faiss_indexes = {}
+            self.chroma_client = None
+            logger.info(f"Using FAISS vector backend at {self.faiss_directory}")
+        else:
+            # Initialize ChromaDB
+            logger.info("Initializing ChromaDB...")
+            self.chroma_client = chromadb.PersistentClient(
+                path=persist_directory,
+                settings=Settings(anonymized_telemetry=False)
+            )
+            self._enable_chroma_wal()
+            # Collection handles by document_id, so hot documents skip the lookup
+            self._collections = {}
+            # Per-document embedding matrix (+ documents, metadatas) loaded
+            # on first query, upcast to float32 and searched in memory
+            self._emb_matrices = {}
+            # Documents with at most brute_force_max_chunks chunks skip Chroma:
+            # their float16 embeddings go to a .npy file and their
+            # texts/metadata to a pickle, searched by brute force
+            self.brute_directory = os.path.join(persist_directory, "brute")
+            os.makedirs(self.brute_directory, exist_ok=True)
+            self.brute_force_max_chunks = 20000
+        
+        if mmr_lambda is None and os.getenv("MMR_LAMBDA"):
+            mmr_lambda = float(os.getenv("MMR_LAMBDA"))
+        self.mmr_lambda = mmr_lambda
+        # Candidates fetched per requested chunk before MMR picks top_k
+        self.mmr_fetch_factor = 4
         
         # Initialize embeddings model (free, local)
         logger.info("Loading embeddings model...")
-        self.embeddings_model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.embedding_backend = (embedding_backend or os.getenv("EMBEDDING_BACKEND", "torch")).lower()
+        if self.embedding_backend == "onnx":
+            self.embeddings_model = OnnxEmbeddingModel(
+                'sentence-transformers/all-MiniLM-L6-v2',
+                cache_dir=os.path.join(persist_directory, "onnx")
+            )
+        else:
+            self.embeddings_model = self._load_torch_model('all-MiniLM-L6-v2')
+        self.embedding_batch_size = embedding_batch_size
         logger.info("Embeddings model loaded successfully")
         
-        # Initialize tokenizer for chunking
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        # Content-addressed embedding cache (SHA-256 of text -> float16 vector),
+        # shared by re-ingested chunks and repeated queries
+        self._emb_cache = diskcache.Cache(os.path.join(persist_directory, "emb_cache"))
+        
+        # Near-duplicate queries reuse earlier retrieval results
+        self._query_cache = SemanticQueryCache(
+            dim=self.embeddings_model.get_sentence_embedding_dimension()
+        )
+        
+        # Chunk with the embedding model's own (fast) tokenizer, so chunk
+        # sizes are measured in the tokens the model actually sees
+        self.tokenizer = self.embeddings_model.tokenizer
+        
+        # Chunk settings. Capped at the model's max_seq_length, since encode()
+        # silently truncates longer inputs and their tail would never be embedded
+        self.chunk_size = min(500, self.embeddings_model.max_seq_length)  # tokens
+        self.chunk_overlap = self.chunk_size // 10  # tokens
         
-        # Chunk settings
-        self.chunk_size = 500  # tokens
-        self.chunk_overlap = 50  # tokens
+        # Vectors per collection.upsert call (one SQLite transaction each)
+        self.chroma_batch_size = 200
+        # Chroma batch writes allowed in flight while later batches embed
+        self.max_concurrent_writes = 4
     
-    def chunk_text(self, text: str, metadata: Dict = None) -> List[Dict]:
+    def _load_torch_model(self, model_name: str) -> SentenceTransformer:
+        """
+        Load the sentence-transformers model on the best available device
+        
+        On CPU, intra-op threads are raised to the core count (PyTorch often
+        defaults lower); on CUDA/MPS the model runs in FP16, halving memory
+        traffic with negligible effect on cosine similarity.
+        """
+        import torch
+        
+        torch.set_num_threads(os.cpu_count() or 1)
+        try:
+            torch.set_num_interop_threads(2)
+        except RuntimeError:
+            # Can only be set before any inter-op parallel work has started
+            pass
+        
+        if torch.cuda.is_available():
+            device = 'cuda'
+        elif torch.backends.mps.is_available():
+            device = 'mps'
+        else:
+            device = 'cpu'
+        
+        model = SentenceTransformer(model_name, device=device)
+        if device != 'cpu':
+            model.half()
+        logger.info(f"Embeddings model running on {device} ({'float16' if device != 'cpu' else 'float32'})")
+        return model
+    
+    def _enable_chroma_wal(self):
+        """
+        Switch Chroma's SQLite file to WAL journaling
+        
+        journal_mode is stored in the database file, so setting it once here
+        also applies to Chroma's own connections (per-connection pragmas such
+        as synchronous cannot be set from outside Chroma).
+        """
+        db_path = os.path.join(self.persist_directory, "chroma.sqlite3")
+        try:
+            with sqlite3.connect(db_path) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+        except Exception as e:
+            logger.warning(f"Could not enable WAL mode for ChromaDB: {e}")
+    
+    def token_offsets(self, texts: List[str]) -> List[List[Tuple[int, int]]]:
+        """
+        Tokenize texts in one batch call, keeping each token's character span
+        
+        The fast tokenizer encodes a batch on all cores in Rust (outside the
+        GIL), so a whole document tokenizes in parallel instead of page by page.
+        
+        Args:
+            texts: Texts to tokenize
+        
+        Returns:
+            Per text, the (start, end) character offsets of its tokens
+        """
+        if not texts:
+            return []
+        return self.tokenizer(
+            texts,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False
+        )['offset_mapping']
+    
+    def chunk_text(
+        self,
+        text: str,
+        metadata: Dict = None,
+        offsets: Optional[List[Tuple[int, int]]] = None
+    ) -> List[Dict]:
         """
         Split text into chunks with overlap
         
         Args:
             text: Text to chunk
             metadata: Metadata to attach to each chunk
+            offsets: Token offsets of text from token_offsets(), if already computed
         
         Returns:
             List of chunks with metadata
@@ -69,39 +473,82 @@ class RAGPipeline:
         if not text or not text.strip():
             return []
         
-        # Tokenize text
-        tokens = self.tokenizer.encode(text)
+        if offsets is None:
+            offsets = self.token_offsets([text])[0]
         
-        chunks = []
-        start = 0
-        chunk_id = 0
+        # Window starts, moving by chunk_size - chunk_overlap
+        starts = range(0, len(offsets), self.chunk_size - self.chunk_overlap)
+        ends = [min(start + self.chunk_size, len(offsets)) for start in starts]
         
-        while start < len(tokens):
-            # Get chunk
-            end = min(start + self.chunk_size, len(tokens))
-            chunk_tokens = tokens[start:end]
-            
-            # Decode back to text
-            chunk_text = self.tokenizer.decode(chunk_tokens)
-            
-            # Create chunk with metadata
-            chunk = {
+        # Slice each window out of the original text (no decode pass)
+        chunk_texts = [
+            text[offsets[start][0]:offsets[end - 1][1]]
+            for start, end in zip(starts, ends)
+        ]
+        
+        # Create chunks with metadata
+        chunks = [
+            {
                 'text': chunk_text,
                 'chunk_id': chunk_id,
                 'start_token': start,
                 'end_token': end,
                 'metadata': metadata or {}
             }
-            
-            chunks.append(chunk)
-            chunk_id += 1
-            
-            # Move start position with overlap
-            start += self.chunk_size - self.chunk_overlap
+            for chunk_id, (chunk_text, start, end) in enumerate(zip(chunk_texts, starts, ends))
+        ]
         
-        logger.info(f"Created {len(chunks)} chunks from text of {len(tokens)} tokens")
+        logger.info(f"Created {len(chunks)} chunks from text of {len(offsets)} tokens")
         return chunks
     
+    def embed_texts(self, texts: List[str], show_progress_bar: bool = False) -> np.ndarray:
+        """
+        Embed texts with the sentence-transformers model
+        
+        Texts already in the embedding cache are not re-encoded. encode()
+        sorts the misses by length before batching (and restores the input
+        order afterwards), so each mini-batch is padded only to similar lengths.
+        
+        Embeddings are kept as float16: MiniLM's normalized outputs are well
+        within FP16 range, and it halves the bytes cached and held in memory.
+        
+        Args:
+            texts: Texts to embed
+            show_progress_bar: Show a progress bar while encoding
+        
+        Returns:
+            L2-normalized float16 embeddings, one row per text
+        """
+        # Key on the backend too: int8 ONNX vectors differ slightly from torch ones
+        keys = [
+            hashlib.sha256(f"{self.embedding_backend}:f16\0{text}".encode()).digest()
+            for text in texts
+        ]
+        cached = [self._emb_cache.get(key) for key in keys]
+        misses = [idx for idx, vector in enumerate(cached) if vector is None]
+        
+        if misses:
+            encoded = self.embeddings_model.encode(
+                [texts[idx] for idx in misses],
+                batch_size=self.embedding_batch_size,
+                show_progress_bar=show_progress_bar,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            ).astype(np.float16)
+            
+            with self._emb_cache.transact():
+                for idx, vector in zip(misses, encoded):
+                    self._emb_cache.set(keys[idx], vector.tobytes())
+                    cached[idx] = vector
+        
+        if len(misses) < len(texts):
+            logger.info(f"Embedding cache hits: {len(texts) - len(misses)}/{len(texts)}")
+        
+        return np.vstack([
+            np.frombuffer(vector, dtype=np.float16) if isinstance(vector, bytes) else vector
+            for vector in cached
+        ])
+    
     def create_or_get_collection(self, document_id: str) -> chromadb.Collection:
         """
         Create or get a collection for a document
@@ -112,127 +559,379 @@ class RAGPipeline:
         Returns:
             ChromaDB collection
         """
+        collection = self._collections.get(document_id)
+        if collection is not None:
+            return collection
+        
         collection_name = f"doc_{document_id}"
         
-        try:
-            collection = self.chroma_client.get_collection(name=collection_name)
-            logger.info(f"Retrieved existing collection: {collection_name}")
-        except:
-            collection = self.chroma_client.create_collection(
-                name=collection_name,
-                metadata={"created_at": datetime.now().isoformat()}
-            )
-            logger.info(f"Created new collection: {collection_name}")
+        collection = self.chroma_client.get_or_create_collection(
+            name=collection_name,
+            metadata={"created_at": datetime.now().isoformat()}
+        )
+        logger.info(f"Opened collection: {collection_name}")
         
+        self._collections[document_id] = collection
         return collection
     
-    def add_document(
+    @staticmethod
+    def _add_to_chroma(
+        collection: chromadb.Collection,
+        embeddings: np.ndarray,
+        texts: List[str],
+        metadatas: List[Dict],
+        ids: List[str]
+    ):
+        """
+        Write one batch of chunks to a Chroma collection
+        
+        chromadb 0.4 rejects ndarrays, so the embeddings still have to become
+        lists; doing it here keeps that O(N*D) conversion in the worker thread
+        instead of on the event loop. upsert rather than add: chromadb 0.4's
+        add silently skips ids that already exist, which would keep stale
+        chunks when a document is re-ingested.
+        """
+        collection.upsert(
+            embeddings=embeddings.tolist(),
+            documents=texts,
+            metadatas=metadatas,
+            ids=ids
+        )
+    
+    def _brute_paths(self, document_id: str) -> tuple[str, str]:
+        """Return (matrix_path, records_path) for a document's brute-force files"""
+        base = os.path.join(self.brute_directory, f"doc_{document_id}")
+        return f"{base}.npy", f"{base}.pkl"
+    
+    def _save_brute(
+        self,
+        document_id: str,
+        embeddings: np.ndarray,
+        texts: List[str],
+        metadatas: List[Dict],
+        ids: List[str]
+    ):
+        """
+        Write a document's brute-force matrix and records from its chunks
+        
+        Any earlier files for the document are overwritten, so re-ingesting a
+        document does not duplicate its chunks (as with Chroma upserts).
+        """
+        self._emb_matrices.pop(document_id, None)
+        matrix_path, records_path = self._brute_paths(document_id)
+        
+        # One row per chunk id, the last occurrence winning
+        rows = list({chunk_id: row for row, chunk_id in enumerate(ids)}.values())
+        records = {
+            'ids': [ids[row] for row in rows],
+            'texts': [texts[row] for row in rows],
+            'metadatas': [metadatas[row] for row in rows]
+        }
+        
+        # Write both files next to their targets and rename them into place:
+        # another worker (or a concurrent query) may have the old .npy mapped,
+        # and truncating a mapped file can kill it with SIGBUS
+        self._replace_file(
+            matrix_path,
+            lambda f: np.save(f, np.ascontiguousarray(embeddings[rows], dtype=np.float16))
+        )
+        self._replace_file(records_path, lambda f: pickle.dump(records, f))
+    
+    def _replace_file(self, path: str, write):
+        """Atomically replace path with the bytes write(file) produces"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    
+    def _faiss_paths(self, document_id: str) -> tuple[str, str]:
+        """Return (index_path, records_path) for a document's FAISS files"""
+        base = os.path.join(self.faiss_directory, f"doc_{document_id}")
+        return f"{base}.index", f"{base}.pkl"
+    
+    def _get_faiss_index(self, document_id: str) -> Optional[tuple]:
+        """
+        Load (and memoize) a document's FAISS index and chunk records
+        
+        Args:
+            document_id: Unique document identifier
+        
+        Returns:
+            Tuple of (index, records) or None if the document is not indexed
+        """
+        if document_id in self._faiss_indexes:
+            return self._faiss_indexes[document_id]
+        
+        index_path, records_path = self._faiss_paths(document_id)
+        if not os.path.exists(index_path):
+            return None
+        
+        index = self.faiss.read_index(index_path)
+        with open(records_path, 'rb') as f:
+            records = pickle.load(f)
+        
+        self._faiss_indexes[document_id] = (index, records)
+        return index, records
+    
+    def _new_faiss_index(self, dim: int):
+        """
+        Create an empty FAISS index for a document
+        
+        int8 scalar quantization stores 1 byte per dimension instead of 4,
+        so search moves a quarter of the memory of a flat fp32 index.
+        """
+        if self.vector_quantization == "int8":
+            return self.faiss.IndexScalarQuantizer(
+                dim,
+                self.faiss.ScalarQuantizer.QT_8bit,
+                self.faiss.METRIC_INNER_PRODUCT
+            )
+        return self.faiss.IndexFlatIP(dim)
+    
+    def _add_to_faiss(
         self,
         document_id: str,
+        embeddings: np.ndarray,
+        texts: List[str],
+        metadatas: List[Dict],
+        ids: List[str]
+    ):
+        """
+        Build a document's FAISS index from its chunks and persist it
+        
+        Any earlier index for the document is replaced rather than appended
+        to, so re-ingesting a document does not duplicate its vectors (as with
+        Chroma, where chunks are upserted by id).
+        """
+        # One row per chunk id, the last occurrence winning
+        rows = list({chunk_id: row for row, chunk_id in enumerate(ids)}.values())
+        embeddings = np.ascontiguousarray(embeddings[rows], dtype='float32')
+        
+        index = self._new_faiss_index(embeddings.shape[1])
+        if not index.is_trained:
+            # The scalar quantizer learns per-dimension ranges from the data
+            index.train(embeddings)
+        index.add(embeddings)
+        records = [
+            {'id': ids[row], 'text': texts[row], 'metadata': metadatas[row]}
+            for row in rows
+        ]
+        
+        index_path, records_path = self._faiss_paths(document_id)
+        self.faiss.write_index(index, index_path)
+        with open(records_path, 'wb') as f:
+            pickle.dump(records, f)
+        
+        self._faiss_indexes[document_id] = (index, records)
+    
+    def _iter_chunks(
+        self,
         ocr_result: Dict,
+        document_id: str,
         metadata: Dict = None
-    ) -> Dict:
+    ) -> Iterator[Tuple[str, str, Dict]]:
         """
-        Process OCR result and add to vector database
+        Yield every text, table and form chunk of a document, page by page
         
         Args:
-            document_id: Unique document identifier
             ocr_result: OCR processing result from ocr_pipeline
+            document_id: Unique document identifier
             metadata: Additional metadata
         
-        Returns:
-            Processing summary
+        Yields:
+            (chunk_id, text, metadata) tuples
         """
-        logger.info(f"Processing document {document_id} for RAG...")
-        
-        collection = self.create_or_get_collection(document_id)
+        pages = ocr_result['pages']
+        # One shared string object for the ID repeated in every chunk's metadata
+        document_id = sys.intern(document_id)
         
-        all_chunks = []
-        texts_to_embed = []
-        chunk_metadata_list = []
-        chunk_ids = []
+        # Tokenize every page's text in one parallel batch call
+        page_offsets = self.token_offsets([page.get('text', '') for page in pages])
         
-        # Process each page
-        for page in ocr_result['pages']:
+        for page, offsets in zip(pages, page_offsets):
             page_num = page['page_num']
+            tables = page.get('tables', [])
+            forms = page.get('forms', [])
             
-            # Prepare page metadata
+            # Prepare page metadata, shared by reference by all text chunks.
+            # Kept small since Chroma pickles it per chunk: has_tables/has_forms
+            # are ints and only stored when set
             page_metadata = {
                 'document_id': document_id,
                 'page_num': page_num,
-                'source': page['source'],
+                'source': sys.intern(page['source']),
                 'confidence': page['confidence'],
-                'has_tables': len(page.get('tables', [])) > 0,
-                'has_forms': len(page.get('forms', [])) > 0,
                 **(metadata or {})
             }
+            if tables:
+                page_metadata['has_tables'] = 1
+            if forms:
+                page_metadata['has_forms'] = 1
             
             # Chunk page text
             page_text = page.get('text', '')
             if page_text:
-                chunks = self.chunk_text(page_text, page_metadata)
-                
-                for chunk in chunks:
-                    chunk_id = f"{document_id}_p{page_num}_c{chunk['chunk_id']}"
-                    texts_to_embed.append(chunk['text'])
-                    chunk_metadata_list.append(chunk['metadata'])
-                    chunk_ids.append(chunk_id)
-                    all_chunks.append(chunk)
+                for chunk in self.chunk_text(page_text, page_metadata, offsets):
+                    yield f"{document_id}_p{page_num}_c{chunk['chunk_id']}", chunk['text'], chunk['metadata']
             
             # Add table data as separate chunks
-            for table in page.get('tables', []):
+            for table in tables:
                 table_text = f"Table {table['table_id']} (Page {page_num}):\n{table.get('markdown', '')}"
-                table_metadata = {
-                    **page_metadata,
-                    'content_type': 'table',
-                    'table_id': table['table_id'],
-                    'table_accuracy': table['accuracy']
-                }
+                table_metadata = page_metadata.copy()
+                table_metadata['content_type'] = 'table'
+                table_metadata['table_id'] = table['table_id']
+                table_metadata['table_accuracy'] = table['accuracy']
                 
-                chunk_id = f"{document_id}_p{page_num}_t{table['table_id']}"
-                texts_to_embed.append(table_text)
-                chunk_metadata_list.append(table_metadata)
-                chunk_ids.append(chunk_id)
+                yield f"{document_id}_p{page_num}_t{table['table_id']}", table_text, table_metadata
             
             # Add form data as separate chunks
-            for idx, form in enumerate(page.get('forms', [])):
+            for idx, form in enumerate(forms):
                 form_text = f"Form Field (Page {page_num}): {form['field_name']} ({form['field_type']}): {form['field_value']}"
-                form_metadata = {
-                    **page_metadata,
-                    'content_type': 'form',
-                    'field_name': form['field_name'],
-                    'field_type': form['field_type']
-                }
+                form_metadata = page_metadata.copy()
+                form_metadata['content_type'] = 'form'
+                form_metadata['field_name'] = form['field_name']
+                form_metadata['field_type'] = form['field_type']
                 
-                chunk_id = f"{document_id}_p{page_num}_f{idx}"
-                texts_to_embed.append(form_text)
-                chunk_metadata_list.append(form_metadata)
-                chunk_ids.append(chunk_id)
-        
-        # Generate embeddings
-        if texts_to_embed:
-            logger.info(f"Generating embeddings for {len(texts_to_embed)} chunks...")
-            embeddings = self.embeddings_model.encode(
-                texts_to_embed,
-                show_progress_bar=True,
-                convert_to_numpy=True
-            )
-            
-            # Add to ChromaDB
-            collection.add(
-                embeddings=embeddings.tolist(),
-                documents=texts_to_embed,
-                metadatas=chunk_metadata_list,
-                ids=chunk_ids
-            )
+                yield f"{document_id}_p{page_num}_f{idx}", form_text, form_metadata
+    
+    def _embed_next_batch(self, chunks: Iterator[Tuple[str, str, Dict]]) -> Optional[tuple]:
+        """
+        Pull the next chroma_batch_size chunks from _iter_chunks and embed them
+        
+        Meant to run in a worker thread: advancing the generator does the
+        tokenization and chunking, which would otherwise block the event loop.
+        
+        Returns:
+            (ids, texts, metadatas, embeddings), or None once chunks is exhausted
+        """
+        batch = list(islice(chunks, self.chroma_batch_size))
+        if not batch:
+            return None
+        ids, texts, metadatas = (list(column) for column in zip(*batch))
+        return ids, texts, metadatas, self.embed_texts(texts)
+    
+    def add_document(
+        self,
+        document_id: str,
+        ocr_result: Dict,
+        metadata: Dict = None
+    ) -> Dict:
+        """
+        Synchronous wrapper around add_document_async
+        
+        Must not be called from a thread with a running event loop.
+        """
+        return asyncio.run(self.add_document_async(document_id, ocr_result, metadata))
+    
+    async def add_document_async(
+        self,
+        document_id: str,
+        ocr_result: Dict,
+        metadata: Dict = None
+    ) -> Dict:
+        """
+        Process OCR result and add to vector database
+        
+        Chunks are streamed from _iter_chunks and embedded chroma_batch_size
+        at a time, so memory stays bounded regardless of document size. With
+        Chroma, embedding and writes are pipelined: batch N is embedded while
+        earlier batches are still being written (up to max_concurrent_writes
+        in flight), so the model is not idle during I/O. Documents that end up
+        with at most brute_force_max_chunks chunks are saved for brute-force
+        search instead and never reach Chroma.
+        
+        Args:
+            document_id: Unique document identifier
+            ocr_result: OCR processing result from ocr_pipeline
+            metadata: Additional metadata
+        
+        Returns:
+            Processing summary
+        """
+        logger.info(f"Processing document {document_id} for RAG...")
+        
+        collection_name = f"doc_{document_id}"
+        # Only opened once a Chroma document outgrows brute_force_max_chunks
+        collection = None
+        
+        semaphore = asyncio.Semaphore(self.max_concurrent_writes)
+        
+        async def write_batch(ids: List[str], texts: List[str], metadatas: List[Dict], embeddings: np.ndarray):
+            try:
+                await asyncio.to_thread(self._add_to_chroma, collection, embeddings, texts, metadatas, ids)
+            finally:
+                semaphore.release()
+        
+        # Embed chunks as they are produced, one batch at a time; with Chroma
+        # each batch's write overlaps embedding of the following batches.
+        # FAISS and brute-force documents are held and written once at the end
+        total_chunks = 0
+        writes = []
+        held_batches = []
+        chunks = self._iter_chunks(ocr_result, document_id, metadata)
+        try:
+            while True:
+                # Chunking (tokenization included) runs in the thread with embedding
+                batch = await asyncio.to_thread(self._embed_next_batch, chunks)
+                if batch is None:
+                    break
+                total_chunks += len(batch[0])
+                
+                if self.vector_backend == "faiss" or (
+                    collection is None and total_chunks <= self.brute_force_max_chunks
+                ):
+                    held_batches.append(batch)
+                    continue
+                
+                if collection is None:
+                    # Too large for brute force: move the held batches to Chroma
+                    collection = await asyncio.to_thread(self.create_or_get_collection, document_id)
+                    pending, held_batches = held_batches, []
+                else:
+                    pending = []
+                pending.append(batch)
+                
+                for pending_batch in pending:
+                    # Blocks while max_concurrent_writes batches are in flight,
+                    # so at most that many embedded batches are held in memory
+                    await semaphore.acquire()
+                    writes.append(asyncio.create_task(write_batch(*pending_batch)))
             
-            logger.info(f"Added {len(texts_to_embed)} chunks to vector database")
+            if held_batches:
+                # One write per document; FAISS training needs all the vectors anyway
+                ids, texts, metadatas, embeddings = zip(*held_batches)
+                await asyncio.to_thread(
+                    self._add_to_faiss if self.vector_backend == "faiss" else self._save_brute,
+                    document_id,
+                    np.vstack(embeddings),
+                    [text for batch_texts in texts for text in batch_texts],
+                    [meta for batch_metadatas in metadatas for meta in batch_metadatas],
+                    [chunk_id for batch_ids in ids for chunk_id in batch_ids]
+                )
+        finally:
+            # Never leave started writes unawaited, even if embedding failed
+            write_results = await asyncio.gather(*writes, return_exceptions=True)
+        
+        for result in write_results:
+            if isinstance(result, BaseException):
+                raise result
+        
+        if self.vector_backend != "faiss":
+            self._emb_matrices.pop(document_id, None)
+        
+        if total_chunks:
+            self._query_cache.invalidate(document_id)
+            logger.info(f"Added {total_chunks} chunks to vector database")
         
         summary = {
             'document_id': document_id,
-            'total_chunks': len(texts_to_embed),
+            'total_chunks': total_chunks,
             'total_pages': len(ocr_result['pages']),
-            'collection_name': collection.name,
+            'collection_name': collection_name,
             'status': 'success'
         }
         
@@ -243,7 +942,7 @@ class RAGPipeline:
         document_id: str,
         query: str,
         top_k: int = 5
-    ) -> List[Dict]:
+    ) -> ChunkBatch:
         """
         Retrieve relevant chunks for a query
         
@@ -253,42 +952,147 @@ class RAGPipeline:
             top_k: Number of chunks to retrieve
         
         Returns:
-            List of relevant chunks with metadata and scores
+            ChunkBatch of relevant chunk texts, page numbers, scores and
+            metadata (empty on error)
         """
         try:
-            collection = self.create_or_get_collection(document_id)
-            
             # Generate query embedding
-            query_embedding = self.embeddings_model.encode(
-                [query],
-                convert_to_numpy=True
-            )[0]
+            query_embedding = self.embed_texts([query])[0]
             
-            # Search in vector database
-            results = collection.query(
-                query_embeddings=[query_embedding.tolist()],
-                n_results=top_k,
-                include=['documents', 'metadatas', 'distances']
-            )
+            cached_chunks = self._query_cache.get(document_id, top_k, query_embedding)
+            if cached_chunks is not None:
+                logger.info(f"Semantic cache hit for query: {query[:50]}...")
+                return cached_chunks
             
-            # Format results
-            relevant_chunks = []
-            if results['documents'] and len(results['documents'][0]) > 0:
-                for idx, doc in enumerate(results['documents'][0]):
-                    chunk = {
-                        'text': doc,
-                        'metadata': results['metadatas'][0][idx],
-                        'similarity_score': 1 - results['distances'][0][idx],  # Convert distance to similarity
-                        'rank': idx + 1
-                    }
-                    relevant_chunks.append(chunk)
+            if self.vector_backend == "faiss":
+                relevant_chunks = self._retrieve_from_faiss(document_id, query_embedding, top_k)
+            else:
+                relevant_chunks = self._retrieve_from_chroma(document_id, query_embedding, top_k)
             
-            logger.info(f"Retrieved {len(relevant_chunks)} relevant chunks for query: {query[:50]}...")
+            if relevant_chunks.texts:
+                self._query_cache.put(document_id, top_k, query_embedding, relevant_chunks)
+            
+            logger.info(f"Retrieved {len(relevant_chunks.texts)} relevant chunks for query: {query[:50]}...")
             return relevant_chunks
             
         except Exception as e:
             logger.error(f"Error retrieving chunks: {e}")
-            return []
+            return make_chunk_batch([], [], [])
+    
+    def _get_emb_matrix(self, document_id: str) -> Optional[tuple]:
+        """
+        Load (once) a document's chunk embeddings, texts and metadata
+        
+        Brute-force documents are read from their .npy/.pkl files, all
+        others with a single Chroma get().
+        
+        Returns:
+            (float32 embedding matrix, documents, metadatas), or None if the
+            document has no chunks
+        """
+        loaded = self._emb_matrices.get(document_id)
+        if loaded is not None:
+            return loaded
+        
+        matrix_path, records_path = self._brute_paths(document_id)
+        if os.path.exists(matrix_path):
+            for _ in range(3):
+                matrix = np.load(matrix_path)
+                with open(records_path, 'rb') as f:
+                    records = pickle.load(f)
+                if len(matrix) == len(records['texts']):
+                    break
+                # Read between the two renames of a concurrent _save_brute
+            else:
+                logger.warning(f"Brute-force files for document {document_id} are out of sync")
+                return None
+            # Stored as float16, but NumPy has no BLAS path (and only
+            # half-precision accumulation) for it, so search in float32
+            matrix = matrix.astype(np.float32)
+            loaded = (matrix, records['texts'], records['metadatas'])
+        else:
+            collection = self.create_or_get_collection(document_id)
+            results = collection.get(include=['embeddings', 'documents', 'metadatas'])
+            if not results['ids']:
+                return None
+            matrix = np.ascontiguousarray(results['embeddings'], dtype=np.float32)
+            loaded = (matrix, results['documents'], results['metadatas'])
+        
+        self._emb_matrices[document_id] = loaded
+        logger.info(f"Loaded {len(matrix)} embeddings for document {document_id} into memory")
+        return loaded
+    
+    def _rerank_mmr(
+        self,
+        matrix: np.ndarray,
+        scores: np.ndarray,
+        candidates: np.ndarray,
+        top_k: int
+    ) -> np.ndarray:
+        """Reorder candidate rows by maximal marginal relevance, keeping top_k"""
+        selected = _mmr_select(
+            matrix[candidates],
+            scores[candidates].astype(np.float32),
+            top_k,
+            self.mmr_lambda
+        )
+        return candidates[selected]
+    
+    def _retrieve_from_chroma(
+        self,
+        document_id: str,
+        query_embedding: np.ndarray,
+        top_k: int
+    ) -> ChunkBatch:
+        """Search a document's embeddings in memory (see retrieve_relevant_chunks)"""
+        loaded = self._get_emb_matrix(document_id)
+        if loaded is None:
+            return make_chunk_batch([], [], [])
+        matrix, documents, metadatas = loaded
+        
+        # Cosine similarity of every chunk in one matrix-vector product
+        scores = matrix @ query_embedding.astype(np.float32)
+        
+        fetch_k = top_k * self.mmr_fetch_factor if self.mmr_lambda is not None else top_k
+        fetch_k = min(fetch_k, len(scores))
+        candidates = np.argpartition(-scores, fetch_k - 1)[:fetch_k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        
+        if self.mmr_lambda is not None:
+            candidates = self._rerank_mmr(matrix, scores, candidates, top_k)
+        
+        candidates = candidates[:top_k]
+        return make_chunk_batch(
+            [documents[row] for row in candidates],
+            [metadatas[row] for row in candidates],
+            scores[candidates]  # Cosine similarity, same scale as FAISS
+        )
+    
+    def _retrieve_from_faiss(
+        self,
+        document_id: str,
+        query_embedding: np.ndarray,
+        top_k: int
+    ) -> ChunkBatch:
+        """Search a document's FAISS index (see retrieve_relevant_chunks)"""
+        loaded = self._get_faiss_index(document_id)
+        if loaded is None:
+            logger.warning(f"No FAISS index for document {document_id}")
+            return make_chunk_batch([], [], [])
+        index, records = loaded
+        
+        scores, indices = index.search(
+            np.ascontiguousarray(query_embedding.reshape(1, -1), dtype='float32'),
+            min(top_k, index.ntotal)
+        )
+        
+        found = indices[0] >= 0
+        rows = indices[0][found]
+        return make_chunk_batch(
+            [records[row]['text'] for row in rows],
+            [records[row]['metadata'] for row in rows],
+            scores[0][found]  # Inner product of normalized vectors
+        )
     
     def delete_document(self, document_id: str) -> bool:
         """
@@ -302,6 +1106,25 @@ class RAGPipeline:
         """
         try:
             collection_name = f"doc_{document_id}"
+            self._query_cache.invalidate(document_id)
+            if self.vector_backend == "faiss":
+                self._faiss_indexes.pop(document_id, None)
+                for path in self._faiss_paths(document_id):
+                    if os.path.exists(path):
+                        os.remove(path)
+                logger.info(f"Deleted FAISS index: {collection_name}")
+                return True
+            
+            self._emb_matrices.pop(document_id, None)
+            brute_paths = [path for path in self._brute_paths(document_id) if os.path.exists(path)]
+            if brute_paths:
+                # Brute-force documents never had a Chroma collection
+                for path in brute_paths:
+                    os.remove(path)
+                logger.info(f"Deleted brute-force index: {collection_name}")
+                return True
+            
+            self._collections.pop(document_id, None)
             self.chroma_client.delete_collection(name=collection_name)
             logger.info(f"Deleted collection: {collection_name}")
             return True
@@ -317,12 +1140,24 @@ class RAGPipeline:
             List of document IDs
         """
         try:
+            if self.vector_backend == "faiss":
+                return [
+                    name[len('doc_'):-len('.index')]
+                    for name in os.listdir(self.faiss_directory)
+                    if name.startswith('doc_') and name.endswith('.index')
+                ]
+            
             collections = self.chroma_client.list_collections()
             doc_ids = [
                 col.name.replace('doc_', '')
                 for col in collections
                 if col.name.startswith('doc_')
             ]
+            doc_ids.extend(
+                name[len('doc_'):-len('.npy')]
+                for name in os.listdir(self.brute_directory)
+                if name.startswith('doc_') and name.endswith('.npy')
+            )
             return doc_ids
         except Exception as e:
             logger.error(f"Error listing documents: {e}")
@@ -332,6 +1167,22 @@ class RAGPipeline:
 class LLMHandler:
     """Handler for LLM-based question answering"""
     
+    # Characters of each chunk sent as context (~500 tokens)
+    MAX_CHARS_PER_CHUNK = 2000
+    # Chunks below this cosine similarity are not worth their prompt tokens
+    # (relevant all-MiniLM-L6-v2 hits usually score 0.3-0.6)
+    MIN_SIMILARITY = 0.2
+    
+    # Fixed parts of the prompt, built once rather than per request
+    _SYSTEM_PROMPT = (
+        "You are a helpful AI assistant that answers questions based on PDF documents. "
+        "Use the provided context to answer questions accurately. "
+        "If the answer is not in the context, say so. "
+        "Always cite the page number when referencing information."
+    )
+    _USER_PREFIX = "Context from document:\n\n"
+    _Q_SUFFIX = "\n\nQuestion: "
+    
     def __init__(self, api_key: Optional[str] = None, model: str = "gpt-4o-mini"):
         """
         Initialize LLM handler
@@ -344,6 +1195,7 @@ class LLMHandler:
         # Only parameter or env var — safest & correct
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         self.model = model
+        self._system_msg = {"role": "system", "content": self._SYSTEM_PROMPT}
 
         # Debug logging (never log full key)
         if self.api_key:
@@ -377,7 +1229,7 @@ class LLMHandler:
     def generate_answer(
         self,
         question: str,
-        context_chunks: List[Dict],
+        context_chunks: ChunkBatch,
         conversation_history: List[Dict] = None
     ) -> Dict:
         """
@@ -385,7 +1237,7 @@ class LLMHandler:
         
         Args:
             question: User question
-            context_chunks: Retrieved relevant chunks
+            context_chunks: ChunkBatch from RAGPipeline.retrieve_relevant_chunks
             conversation_history: Previous conversation (optional)
         
         Returns:
@@ -398,25 +1250,25 @@ class LLMHandler:
                 'error': 'LLM not enabled'
             }
         
+        # Keep only chunks relevant enough to be worth sending
+        keep = np.flatnonzero(context_chunks.scores >= self.MIN_SIMILARITY)
+        if not len(keep):
+            return {
+                'answer': 'I could not find relevant information in the document to answer your question.',
+                'sources': [],
+                'model': self.model,
+                'context_used': 0
+            }
+        
         try:
-            # Build context from chunks
-            context_text = "\n\n".join([
-                f"[Page {chunk['metadata'].get('page_num', 'N/A')}] {chunk['text']}"
-                for chunk in context_chunks
-            ])
+            # Build context from chunks, truncating long ones
+            context_text = "\n\n".join(
+                f"[Page {context_chunks.page_nums[idx]}] {context_chunks.texts[idx][:self.MAX_CHARS_PER_CHUNK]}"
+                for idx in keep
+            )
             
             # Build messages
-            messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a helpful AI assistant that answers questions based on PDF documents. "
-                        "Use the provided context to answer questions accurately. "
-                        "If the answer is not in the context, say so. "
-                        "Always cite the page number when referencing information."
-                    )
-                }
-            ]
+            messages = [self._system_msg]
             
             # Add conversation history if provided
             if conversation_history:
@@ -425,7 +1277,7 @@ class LLMHandler:
             # Add current question with context
             messages.append({
                 "role": "user",
-                "content": f"Context from document:\n\n{context_text}\n\nQuestion: {question}"
+                "content": self._USER_PREFIX + context_text + self._Q_SUFFIX + question
             })
             
             # Generate response
@@ -441,18 +1293,18 @@ class LLMHandler:
             # Extract sources
             sources = [
                 {
-                    'page_num': chunk['metadata'].get('page_num'),
-                    'similarity_score': chunk['similarity_score'],
-                    'text_preview': chunk['text'][:200] + '...'
+                    'page_num': context_chunks.metadatas[idx].get('page_num'),
+                    'similarity_score': float(context_chunks.scores[idx]),
+                    'text_preview': context_chunks.texts[idx][:200] + '...'
                 }
-                for chunk in context_chunks[:3]  # Top 3 sources
+                for idx in keep[:3]  # Top 3 sources
             ]
             
             return {
                 'answer': answer,
                 'sources': sources,
                 'model': self.model,
-                'context_used': len(context_chunks)
+                'context_used': len(keep)
             }
             
         except Exception as e:
@@ -0,0 +1,66 @@
+"""
+Tests for OCRPipeline.run_ocr with a fake OCR engine
+"""
+
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+for module in ("cv2", "fitz", "paddleocr", "camelot", "pandas"):
+    pytest.importorskip(module)
+
+from ocr_pipeline import OCRPipeline
+
+
+class FakePaddleOCR:
+    """Mimics PaddleOCR.ocr(): one image per call, result wrapped in a list"""
+
+    def __init__(self, lines_per_image):
+        self.lines_per_image = list(lines_per_image)
+        self.calls = []
+
+    def ocr(self, image, cls=True):
+        if isinstance(image, list):
+            # Real PaddleOCR logs an error and calls exit(0) for a list
+            raise SystemExit(0)
+        self.calls.append(image)
+        return [self.lines_per_image[len(self.calls) - 1]]
+
+
+def make_pipeline(engine):
+    pipeline = OCRPipeline.__new__(OCRPipeline)
+    pipeline.ocr = engine
+    pipeline._ocr_lock = threading.Lock()
+    return pipeline
+
+
+def line(text, confidence):
+    box = [[0, 0], [10, 0], [10, 10], [0, 10]]
+    return [box, (text, confidence)]
+
+
+def test_run_ocr_passes_single_images_and_parses_each_result():
+    engine = FakePaddleOCR([
+        [line("first", 0.9), line("page", 0.7)],
+        [line("second", 0.5)],
+        [line("third", 1.0)],
+    ])
+    pipeline = make_pipeline(engine)
+    images = [np.zeros((8, 8), dtype=np.uint8) for _ in range(3)]
+
+    results = [pipeline.run_ocr(image) for image in images]
+
+    assert len(engine.calls) == 3
+    assert [text for text, _ in results] == ["first\npage", "second", "third"]
+    assert [confidence for _, confidence in results] == pytest.approx([0.8, 0.5, 1.0])
+
+
+def test_run_ocr_handles_images_without_text():
+    engine = FakePaddleOCR([None, [line("text", 0.6)]])
+    pipeline = make_pipeline(engine)
+    images = [np.zeros((8, 8), dtype=np.uint8) for _ in range(2)]
+
+    results = [pipeline.run_ocr(image) for image in images]
+
+    assert results == [("", 0.0), ("text", pytest.approx(0.6))]
@@ -0,0 +1,114 @@
+"""
+Tests that re-ingesting a document replaces its brute-force and FAISS
+stores instead of appending to them, with a stub tokenizer and embedder
+"""
+
+import asyncio
+import pickle
+import re
+
+import pytest
+
+np = pytest.importorskip("numpy")
+for module in ("chromadb", "sentence_transformers", "diskcache", "dotenv"):
+    pytest.importorskip(module)
+
+from rag_pipeline import RAGPipeline
+
+DIM = 8
+
+
+class FakeTokenizer:
+    """Mimics a fast tokenizer's offset mapping, one token per word"""
+
+    def __call__(self, texts, **kwargs):
+        return {
+            'offset_mapping': [
+                [match.span() for match in re.finditer(r"\S+", text)]
+                for text in texts
+            ]
+        }
+
+
+class FakeQueryCache:
+    def __init__(self):
+        self.invalidated = []
+
+    def invalidate(self, document_id):
+        self.invalidated.append(document_id)
+
+
+def fake_embed_texts(texts, show_progress_bar=False):
+    rows = []
+    for text in texts:
+        rng = np.random.default_rng(len(text))
+        vector = rng.standard_normal(DIM).astype(np.float32)
+        rows.append(vector / np.linalg.norm(vector))
+    return np.asarray(rows, dtype=np.float16)
+
+
+def make_pipeline(tmp_path, vector_backend="chroma"):
+    pipeline = RAGPipeline.__new__(RAGPipeline)
+    pipeline.vector_backend = vector_backend
+    pipeline.chroma_batch_size = 3
+    pipeline.max_concurrent_writes = 2
+    pipeline.brute_force_max_chunks = 20000
+    pipeline._emb_matrices = {}
+    pipeline.brute_directory = str(tmp_path)
+    pipeline._query_cache = FakeQueryCache()
+    pipeline.tokenizer = FakeTokenizer()
+    pipeline.chunk_size = 4
+    pipeline.chunk_overlap = 1
+    pipeline.embed_texts = fake_embed_texts
+    return pipeline
+
+
+def make_ocr_result():
+    return {
+        'pages': [
+            {
+                'page_num': page_num,
+                'text': " ".join(f"word{page_num}_{i}" for i in range(10)),
+                'source': 'text',
+                'confidence': 1.0,
+            }
+            for page_num in range(1, 4)
+        ]
+    }
+
+
+def test_reingesting_replaces_brute_force_files(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+
+    first = asyncio.run(pipeline.add_document_async("doc", make_ocr_result()))
+    second = asyncio.run(pipeline.add_document_async("doc", make_ocr_result()))
+
+    assert first['total_chunks'] == second['total_chunks'] > 0
+    matrix_path, records_path = pipeline._brute_paths("doc")
+    with open(records_path, 'rb') as f:
+        records = pickle.load(f)
+    assert len(np.load(matrix_path)) == first['total_chunks']
+    assert len(records['ids']) == len(set(records['ids'])) == first['total_chunks']
+
+    matrix, documents, _ = pipeline._get_emb_matrix("doc")
+    assert matrix.dtype == np.float32
+    assert len(matrix) == len(documents) == first['total_chunks']
+
+
+def test_reingesting_replaces_faiss_index(tmp_path):
+    faiss = pytest.importorskip("faiss")
+    pipeline = make_pipeline(tmp_path, vector_backend="faiss")
+    pipeline.faiss = faiss
+    pipeline.faiss_directory = str(tmp_path)
+    pipeline._faiss_indexes = {}
+    pipeline.vector_quantization = "none"
+
+    first = asyncio.run(pipeline.add_document_async("doc", make_ocr_result()))
+    second = asyncio.run(pipeline.add_document_async("doc", make_ocr_result()))
+
+    assert first['total_chunks'] == second['total_chunks'] > 0
+    index, records = pipeline._faiss_indexes["doc"]
+    assert index.ntotal == len(records) == first['total_chunks']
+
+    index_path, _ = pipeline._faiss_paths("doc")
+    assert faiss.read_index(index_path).ntotal == first['total_chunks']